@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Script to benchmark similar texts retrieval, queries/sec
+1. get_similar_texts: one embedding and one DB statement per query
+2. get_similar_texts_batch: batched embeddings, one DB statement per _QRY_BATCH queries
+Usage: python bench_retrieval.py [queries_file [part_key]], one query per line
+part_key limits the search to a partition, e.g. runtime/7_2_17, see pgvector_partitioned.sql
+"""
+
+import sys
+from time import perf_counter
+
+from coreconfigs import _QRY_BATCH
+from coreutils import Embeds
+
+
+part_key = sys.argv[2] if len(sys.argv) > 2 else ''
+if len(sys.argv) > 1:
+    with open(sys.argv[1], encoding="utf-8", errors="replace") as qfl:
+        qrys = [line.strip() for line in qfl if line.strip()]
+else:
+    qrys = [f"{qry} {topic}" for qry in ("what is", "how to configure", "how to troubleshoot")
+            for topic in ("atlas", "ranger", "hive", "impala", "kafka", "iceberg", "spark",
+                          "hbase", "nifi", "flink", "ozone", "yarn")]*4
+
+embd = Embeds()
+# Warm up, model and DB connection
+_ = embd.get_similar_texts_batch(qrys[:2], part_key)
+
+btime = perf_counter()
+loop_ctx = [embd.get_similar_texts(qry, part_key=part_key) for qry in qrys]
+loop_time = perf_counter() - btime
+
+btime = perf_counter()
+batch_ctx = [ctx for _, ctx in embd.iter_similar_texts_batch(qrys, _QRY_BATCH, part_key)]
+batch_time = perf_counter() - btime
+
+print(f"Queries: {len(qrys)}, batch size: {_QRY_BATCH}")
+print(f"Per query loop: {len(qrys)/loop_time:.1f} queries/sec")
+print(f"Batch: {len(qrys)/batch_time:.1f} queries/sec, speedup {loop_time/batch_time:.2f}x")
+print(f"Same contexts: {sum(lctx == bctx for lctx, bctx in zip(loop_ctx, batch_ctx))}/{len(qrys)}")
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Script for bulk loads of text embeddings into pgvector DB
+1. Drop the HNSW index on t_document_chunks, inserts avoid incremental index maintenance
+2. Iterate all files under _TEXTDIR, chunk texts and save chunk+embeddings in pgvector DB
+3. Rebuild the HNSW index using _IDX_MAINT_WORK_MEM and _IDX_PARALLEL_WORKERS
+Options
+  --concurrently: build the index with CREATE INDEX CONCURRENTLY, does not block writes
+  --reindex-only: skip the load, rebuild the indexes of the table or a partition (--part-key)
+"""
+
+import argparse
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from humanize import precisedelta
+
+from coreconfigs import _TEXTDIR
+from coreutils import Embeds, ChunkIndexOps
+
+
+prsr = argparse.ArgumentParser(description="Bulk load embeddings, rebuild HNSW index")
+prsr.add_argument("--concurrently", action="store_true", help="Online index build")
+prsr.add_argument("--reindex-only", action="store_true", help="Only rebuild the indexes")
+prsr.add_argument("--part-key", default='', help="Partition to reindex, e.g. runtime/7_2_17")
+args = prsr.parse_args()
+
+embd = Embeds()
+idxo = ChunkIndexOps(embd)
+if args.reindex_only:
+    try:
+        rtime = idxo.reindex(args.part_key, args.concurrently)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    print(f"Reindex time: {precisedelta(rtime)}")
+else:
+    idxo.drop_index()
+    print("HNSW index dropped.")
+    btime = datetime.now()
+    try:
+        embd.save_embeddings_to_db(Path(_TEXTDIR))
+        print(f"Load time: {precisedelta(datetime.now() - btime)}")
+    finally:
+        # Rebuild the index even if the load failed, searches need it
+        try:
+            itime = idxo.build_index(args.concurrently)
+            print(f"Index build time: {precisedelta(itime)}")
+        except Exception:
+            print("HNSW index NOT rebuilt, run: python bulk_load.py --reindex-only")
+            raise
@@ -23,12 +23,42 @@ _MAX_TKNLEN = 120
 # LLM
 _LLM_NAME = "HuggingFaceH4/zephyr-7b-beta"
 _LLM_MSG_TMPLT = [{ "role": "system", "content": "",}, {"role": "user", "content": ''},]
+# Optional assisted (speculative) generation. A small draft model proposes tokens,
+# the LLM verifies them in one forward pass. None to disable.
+# Draft model must share the tokenizer (vocabulary) of _LLM_NAME.
+# With greedy decoding, the answer is identical to the LLM alone.
+_LLM_DRAFT_NAME = None
 
 # LLM model sequence length = 4k, we will provide about 1k tokens, _MAX_TKNLEN*_MAX_SIM_TXTS
 # Higher length requires higher GPU processing, memory and can lead to OoM error on smaller GPUs.
 # Reducing context tokens, reduces processing costs.
 # But short contexts may lead to inaccurate or repetitive answers.
 _MAX_SIM_TXTS = 4
+# Queries per DB statement for batch retrieval, e.g. offline evaluation
+_QRY_BATCH = 64
+
+# Optional rerank of similar texts with a small cross-encoder, runs on CPU
+# Over-fetch _RERANK_CANDIDATES texts from vectorDB, score them in one batch and
+# keep the best _RERANK_TOPK texts scoring at least _RERANK_MIN_SCORE (None: no cutoff)
+# Scores are between 0 and 1 (sigmoid of the cross-encoder relevance logit)
+# Fewer, more relevant context tokens reduce LLM processing costs
+_RERANK_ENABLED = False
+_RERANK_MDL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+_RERANK_CANDIDATES = 16
+_RERANK_TOPK = 3
+_RERANK_MIN_SCORE = 0.1
+
+# Semantic answer cache, stored in the same pgvector DB (t_answer_cache)
+# A new query whose nearest cached query (same mode and temperature) has similarity >= threshold
+# is answered from the cache, skipping retrieval and LLM generation.
+# Similarity is the inner product of normalized embeddings, 1.0 is identical.
+# Requires t_answer_cache, existing databases: see pgvector_upgrade.sql
+_CACHE_ENABLED = False
+_CACHE_SIM_THRESHOLD = 0.95
+# Cached answers older than TTL hours are ignored and evicted
+_CACHE_TTL_HRS = 24*7
+# Maximum cached answers, least recently used answers are evicted
+_CACHE_MAX_ROWS = 10000
 
 # Spacy model for sentence segmentation, small is good enough.
 # see comparison https://spacy.io/models/en
@@ -55,6 +85,11 @@ _DOCSREADDIR = "docs_processed"
 _TEXTDIR = "texts_input"
 # Directory to store texts once embeddings are stored in vector DB
 _TXTSREADDIR = "texts_processed"
+# Text files are read, chunked, encoded and saved in vector DB by parallel stages
+# Maximum files waiting between two stages, a full queue blocks the upstream stage
+_INGEST_QSIZE = 8
+# Chunks encoded together by the embedding model
+_ENC_BATCH = 64
 
 
 # Texts to ignore when extracting text from documents
@@ -67,6 +102,16 @@ _TOC = r"Contents.*\.\.\.\ [0-9]+"
 # ignore lines with just digits e.g. page numbers
 _NUMDOTSPACE = re.compile(r'^[0-9\.\ ]*$')
 
+# t_document_chunks HNSW index parameters, see pgvector.sql
+_HNSW_M = 16
+_HNSW_EF_CONSTRUCTION = 128
+# Used by bulk_load.py when (re)building the HNSW index
+# Index build is much faster when the graph fits in maintenance_work_mem
+_IDX_MAINT_WORK_MEM = "1GB"
+_IDX_PARALLEL_WORKERS = 4
+# Set True if t_document_chunks is partitioned by product/version, see pgvector_partitioned.sql
+_PG_PARTITIONED = False
+
 #PgVector DB details
 _PGHOST = "1.1.1.1"
 _PGPORT = 5432
@@ -3,23 +3,33 @@
 
 """ coreutils module: Provides common utilities for other modules """
 from pathlib import Path
-from time import sleep
+from time import sleep, perf_counter
+import re
+import hashlib
+from queue import Queue, Empty, Full
+import threading
 import subprocess
 import sys
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import json
 
 import numpy as np
 import psycopg
+from psycopg import sql
 from humanize import precisedelta
 
 import torch
 import transformers
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import SentenceTransformer, CrossEncoder
 
-from coreconfigs import _LLM_NAME, _LLM_MSG_TMPLT, _EMBED_MDL, _TXTSREADDIR, \
+from coreconfigs import _LLM_NAME, _LLM_MSG_TMPLT, _LLM_DRAFT_NAME, _EMBED_MDL, _TXTSREADDIR, \
                         _DB_EMBED_DIM, _MAX_SIM_TXTS, _MAX_TKNLEN, \
-                        _PGHOST, _PGPORT, _PGUSER, _PGDB, _PGPWD
+                        _PGHOST, _PGPORT, _PGUSER, _PGDB, _PGPWD, \
+                        _CACHE_ENABLED, _CACHE_SIM_THRESHOLD, _CACHE_TTL_HRS, _CACHE_MAX_ROWS, \
+                        _RERANK_ENABLED, _RERANK_MDL, _RERANK_CANDIDATES, _RERANK_TOPK, \
+                        _RERANK_MIN_SCORE, _HNSW_M, _HNSW_EF_CONSTRUCTION, _IDX_MAINT_WORK_MEM, \
+                        _IDX_PARALLEL_WORKERS, _PG_PARTITIONED, _INGEST_QSIZE, _ENC_BATCH, \
+                        _QRY_BATCH
 
 
 class DbOps():
@@ -67,6 +77,10 @@ class DbOps():
         """ Rollback the transaction"""
         self._conn.rollback()
 
+    def autocommit(self, flag):
+        """ Set autocommit, required for statements like CREATE INDEX CONCURRENTLY """
+        self._conn.autocommit = flag
+
 
 class Embeds():
     """
@@ -87,9 +101,14 @@ class Embeds():
             sys.exit(1)
         else:
             print("Embedding model ok.")
+        # Loaded on first rerank, not required for storing embeddings
+        self.rerank_mdl = ''
+        self.idxo = ''
         if dbconn:
             self.dbo = DbOps()
             print("DB connection established.")
+            if _PG_PARTITIONED:
+                self.idxo = ChunkIndexOps(self)
         # similarity: <=> cosine, <-> L2, <#> inner product
         # We normalize embeddings so use <#>
         # Ensure t_document_chunks index is using vector_ip_ops
@@ -99,9 +118,58 @@ class Embeds():
                      "del_txts":"delete from t_document_chunks where doc_id = %s",
                      "ins_txt":"insert into t_document_chunks (doc_id, chunk, embedding) \
                                  values(%s, %s, %s)",
-                     "sim_txts":f"SELECT id, chunk FROM t_document_chunks \
-                                ORDER BY embedding <#> %s LIMIT {_MAX_SIM_TXTS}"
+                     "ins_txt_part":"insert into t_document_chunks (doc_id, chunk, embedding, part_key) \
+                                 values(%s, %s, %s, %s)",
+                     "sim_txts":"SELECT id, chunk, doc_id FROM t_document_chunks \
+                                ORDER BY embedding <#> %s LIMIT %s",
+                     "sim_txts_part":"SELECT id, chunk, doc_id FROM t_document_chunks \
+                                WHERE part_key = %s ORDER BY embedding <#> %s LIMIT %s",
+                     # One ANN search per input embedding, rows ordered by input and similarity
+                     "sim_txts_batch":"SELECT q.ord, c.id, c.chunk, c.doc_id \
+                                FROM unnest(%s::text[]) WITH ORDINALITY AS q(emb, ord) \
+                                CROSS JOIN LATERAL (SELECT id, chunk, doc_id, \
+                                    embedding <#> q.emb::vector AS dist FROM t_document_chunks \
+                                    ORDER BY embedding <#> q.emb::vector LIMIT %s) c \
+                                ORDER BY q.ord, c.dist",
+                     "sim_txts_batch_part":"SELECT q.ord, c.id, c.chunk, c.doc_id \
+                                FROM unnest(%s::text[]) WITH ORDINALITY AS q(emb, ord) \
+                                CROSS JOIN LATERAL (SELECT id, chunk, doc_id, \
+                                    embedding <#> q.emb::vector AS dist FROM t_document_chunks \
+                                    WHERE part_key = %s \
+                                    ORDER BY embedding <#> q.emb::vector LIMIT %s) c \
+                                ORDER BY q.ord, c.dist",
+                     "del_cache_doc":"delete from t_answer_cache where doc_ids @> ARRAY[%s]::bigint[]"
                     }
+        # Document ids behind the last context returned by get_similar_texts
+        self.ctx_doc_ids = []
+        # Latency and context reduction of the last rerank
+        self.rerank_stats = {}
+
+    def get_embedding_str(self, text):
+        """
+        Generate the normalized text embedding
+        Returns the embedding as a json string, used as a pgvector value
+        """
+        embeddings = self.emb_mdl.encode(text)
+        # Normalizing the embeddings, just in case
+        # default is Frobenius norm
+        # https://numpy.org/doc/stable/reference/generated/numpy.linalg.norm.html
+        fnorm = np.linalg.norm(embeddings)
+        lst = list(embeddings/fnorm)
+        # json supports only np.float64. Convert np.float32
+        return json.dumps(lst, default=np.float64)
+
+    def get_embedding_strs(self, texts):
+        """
+        Generate the normalized text embeddings in batches of _ENC_BATCH
+        Returns the embeddings as json strings, used as pgvector values
+        """
+        if not texts:
+            return []
+        embeddings = self.emb_mdl.encode(texts, batch_size=_ENC_BATCH)
+        fnorm = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        # json supports only np.float64. Convert np.float32
+        return [json.dumps(list(emb), default=np.float64) for emb in embeddings/fnorm]
 
     def np_to_str(self, val):
         """Convert np.float32 to np.float64. json.dumps supports it."""
@@ -129,79 +197,128 @@ class Embeds():
         self.dbo.values = ''
         return retval
 
-    def save_embeddings_to_db(self, fldr, parent='.'):
+    def save_embeddings_to_db(self, fldr):
         """
         Iterate all the directories under _TEXTDIR (fldr)
         Read text file, chunk texts and save chunk+embeddings in pgvector DB
+        See IngestPipeline for details
         """
-        for rfl in fldr.iterdir():
-            if rfl.is_file():
-                print(f"Processing text file: {rfl.name}")
-                # If the file has been processed already, delete the document chunks and reprocess
-                docid = self.dbexec(self.dbo_stmts['sel_doc'], (rfl.name, ),
-                                    "Check for Document")
-                if docid:
-                    _ = self.dbexec(self.dbo_stmts['del_txts'], (docid[0][0], ),
-                                    "Deleting document chunks")
-                    _ = self.dbexec(self.dbo_stmts['upd_doc'],
-                                    (datetime.now(tz=timezone.utc), docid[0][0]),
-                                    "Updating document timestamp")
-                else:
-                    docid = self.dbexec(self.dbo_stmts['ins_doc'], (rfl.name, ),
-                                        "Insert Document")
-                with open(rfl, encoding="utf-8", errors="replace") as txt_fl:
-                    filetexts = txt_fl.readlines()
-                txtchunk = ''
-                txtlst = []
-                for txt in filetexts:
-                    txt = txt.strip()
-                    txtchunk = f"{txtchunk} {txt}"
-                    txtlst.append(txt)
-                    if len(txtchunk.split()) >= _MAX_TKNLEN:
-                        embeddings = self.emb_mdl.encode(txtchunk)
-                        # Normalizing the embeddings, just in case
-                        # default is Frobenius norm
-                        # https://numpy.org/doc/stable/reference/generated/numpy.linalg.norm.html
-                        fnorm = np.linalg.norm(embeddings)
-                        lst = list(embeddings/fnorm)
-                        # json supports only np.float64. Convert np.float32
-                        embed_str = json.dumps(lst, default=np.float64)
-                        _ = self.dbexec(self.dbo_stmts['ins_txt'],
-                                        (docid[0][0], json.dumps(txtlst), embed_str),
-                                        "Insert chunk into Document")
-                        txtchunk = ''
-                self.dbo.commit()
-                print(f"Embeddings commited for file: {rfl}")
-                try:
-                    _ = rfl.replace(Path(_TXTSREADDIR, parent, rfl.name))
-                except (PermissionError, FileExistsError, FileNotFoundError) as err:
-                    print(f"File not moved: {err}")
-                    print("Ignoring error...")
-
-            if rfl.is_dir():
-                print(f"Creating text processed directory: {rfl.name}")
-                Path(_TXTSREADDIR, rfl.name).mkdir(parents=True, exist_ok=True)
-                self.save_embeddings_to_db(rfl, rfl.name)
-                # Delete the processed text directory, ignore error if any file exists
-                try:
-                    rfl.rmdir()
-                except (OSError, FileNotFoundError) as err:
-                    print(f"Directory not deleted: {err}")
-                    print("Ignoring error...")
+        return IngestPipeline(self).run(fldr)
 
-    def get_similar_texts(self, text):
+    def get_similar_texts(self, text, embed_str='', part_key=''):
         """
-        1. Generate text embedding.
+        1. Generate text embedding, unless already provided in embed_str.
         2. Compare similarity against vectorDB and get texts similar to the input text.
+           If t_document_chunks is partitioned, part_key (product/version) limits the search
+           to the partition.
+        Document ids of the similar texts are available in ctx_doc_ids
         """
-        embeddings = self.emb_mdl.encode(text)
-        # Normalize before querying the DB
-        fnorm = np.linalg.norm(embeddings)
-        lst = list(embeddings/fnorm)
-        # json supports only np.float64. Convert np.float32
-        embed_str = json.dumps(lst, default=np.float64)
-        sim_txts = self.dbexec(self.dbo_stmts['sim_txts'], (embed_str,), "Get similar texts")
+        if not embed_str:
+            embed_str = self.get_embedding_str(text)
+        limit = _RERANK_CANDIDATES if _RERANK_ENABLED else _MAX_SIM_TXTS
+        if self.idxo and part_key:
+            sim_txts = self.dbexec(self.dbo_stmts['sim_txts_part'], (part_key, embed_str, limit),
+                                   "Get similar texts")
+        else:
+            sim_txts = self.dbexec(self.dbo_stmts['sim_txts'], (embed_str, limit),
+                                   "Get similar texts")
         #print(f"Similar text ids: {[itm[0] for itm in sim_txts]}")
+        if _RERANK_ENABLED:
+            sim_txts = self.rerank_texts(text, sim_txts)
+        self.ctx_doc_ids = sorted({itm[2] for itm in sim_txts})
+        return self.build_context(sim_txts)
+
+    def get_similar_texts_batch(self, texts, part_key=''):
+        """
+        get_similar_texts for a list of texts
+        1. Generate text embeddings in batches.
+        2. Get texts similar to every input text in one DB statement.
+           If t_document_chunks is partitioned, part_key limits the search to the partition.
+        Returns the context for every input text, in order
+        """
+        # Any iterable, texts are used more than once
+        texts = list(texts)
+        if not texts:
+            return []
+        embed_strs = self.get_embedding_strs(texts)
+        limit = _RERANK_CANDIDATES if _RERANK_ENABLED else _MAX_SIM_TXTS
+        if self.idxo and part_key:
+            rows = self.dbexec(self.dbo_stmts['sim_txts_batch_part'], (embed_strs, part_key, limit),
+                               "Get similar texts batch")
+        else:
+            rows = self.dbexec(self.dbo_stmts['sim_txts_batch'], (embed_strs, limit),
+                               "Get similar texts batch")
+        sim_txts_lst = [[] for _ in texts]
+        for itm in rows:
+            sim_txts_lst[itm[0] - 1].append(itm[1:])
+        if _RERANK_ENABLED:
+            sim_txts_lst = self.rerank_texts_batch(texts, sim_txts_lst)
+        return [self.build_context(sim_txts) for sim_txts in sim_txts_lst]
+
+    def iter_similar_texts_batch(self, texts, batch_size=_QRY_BATCH, part_key=''):
+        """
+        Generator for large number of texts, e.g. read from a file
+        Calls get_similar_texts_batch for every batch_size texts.
+        Yields (text, context)
+        """
+        batch = []
+        for text in texts:
+            batch.append(text)
+            if len(batch) >= batch_size:
+                yield from zip(batch, self.get_similar_texts_batch(batch, part_key))
+                batch = []
+        if batch:
+            yield from zip(batch, self.get_similar_texts_batch(batch, part_key))
+
+    def rerank_texts(self, text, sim_txts):
+        """
+        Score the similar texts against the input text with the cross-encoder, in one batch.
+        Returns the best _RERANK_TOPK texts, scoring at least _RERANK_MIN_SCORE
+        The best text is returned even if below _RERANK_MIN_SCORE
+        """
+        return self.rerank_texts_batch([text], [sim_txts])[0]
+
+    def rerank_texts_batch(self, texts, sim_txts_lst):
+        """
+        rerank_texts for a list of texts, all pairs are scored in one cross-encoder batch
+        Returns the reranked similar texts for every input text
+        """
+        pairs = [(text, ' '.join(itm[1])) for text, sim_txts in zip(texts, sim_txts_lst)
+                 for itm in sim_txts]
+        if not pairs:
+            return sim_txts_lst
+        if not self.rerank_mdl:
+            self.rerank_mdl = CrossEncoder(_RERANK_MDL, device="cpu")
+            print("Rerank model ok.")
+        btime = datetime.now()
+        scores = list(self.rerank_mdl.predict(pairs, batch_size=len(pairs)))
+        reranked_lst = []
+        for sim_txts in sim_txts_lst:
+            ranked = sorted(zip(scores[:len(sim_txts)], sim_txts), key=lambda itm: itm[0],
+                            reverse=True)
+            scores = scores[len(sim_txts):]
+            reranked = [itm[1] for itm in ranked[:_RERANK_TOPK]
+                        if _RERANK_MIN_SCORE is None or itm[0] >= _RERANK_MIN_SCORE]
+            # Keep the best text even below the cutoff, an empty context is no context
+            reranked_lst.append(reranked or [itm[1] for itm in ranked[:1]])
+        rtime = datetime.now() - btime
+        # Context tokens without rerank, i.e. top _MAX_SIM_TXTS vectorDB texts
+        ann_tkns = sum(len(self.build_context(sim_txts[:_MAX_SIM_TXTS]).split())
+                       for sim_txts in sim_txts_lst)
+        rrk_tkns = sum(len(self.build_context(reranked).split()) for reranked in reranked_lst)
+        kept = sum(len(reranked) for reranked in reranked_lst)
+        self.rerank_stats = {"candidates": len(pairs), "kept": kept,
+                             "latency_ms": rtime.total_seconds()*1000,
+                             "context_tokens": rrk_tkns, "ann_context_tokens": ann_tkns}
+        print(f"Rerank: kept {kept}/{len(pairs)} texts in {precisedelta(rtime)}, "
+              f"context tokens {ann_tkns} -> {rrk_tkns}")
+        return reranked_lst
+
+    def build_context(self, sim_txts):
+        """
+        Build the LLM context from the similar texts
+        Duplicate sentences are skipped, context is limited to _MAX_TKNLEN*_MAX_SIM_TXTS tokens
+        """
         all_txts = []
         contxt = ''
         # Avoid duplicate sentences, less noise in context is better for LLM response
@@ -215,14 +332,450 @@ class Embeds():
                         break
         return contxt
 
+
+class IngestPipeline():
+    """
+    Staged pipeline to save text files under _TEXTDIR in pgvector DB
+    Stages run in their own threads, connected by bounded queues (backpressure):
+    1. reader: reads text files
+    2. chunker: chunks texts of about _MAX_TKNLEN tokens
+    3. encoder: generates embeddings for chunks of one or more files, in batches of _ENC_BATCH
+    4. writer: saves document chunks+embeddings, checkpoint in one transaction per file,
+       then moves the file to _TXTSREADDIR
+    Committed files are recorded in t_ingest_checkpoint until they are moved.
+    A restarted job skips them, only moving the files left behind.
+    """
+    stages = ("reader", "chunker", "encoder", "writer")
+
+    def __init__(self, emb):
+        self.emb = emb
+        self.queues = [Queue(maxsize=_INGEST_QSIZE) for _ in self.stages[1:]]
+        self.stop = threading.Event()
+        self.errors = []
+        self.done = {}
+        # Per stage: files, chunks processed and busy seconds (excludes waiting on queues)
+        self.stats = {stage: {"files": 0, "chunks": 0, "busy": 0.0} for stage in self.stages}
+        self.ingest_stmts = {"sel_ckpt":"select file_path, fingerprint from t_ingest_checkpoint",
+                        "ups_ckpt":"insert into t_ingest_checkpoint \
+                                (file_path, fingerprint, doc_id, chunks) values(%s, %s, %s, %s) \
+                                on conflict (file_path) do update set fingerprint = EXCLUDED.fingerprint, \
+                                doc_id = EXCLUDED.doc_id, chunks = EXCLUDED.chunks, updated_at = now()",
+                        "del_ckpt":"delete from t_ingest_checkpoint where file_path = %s"
+                       }
+
+    def _put(self, qidx, item):
+        """ Put item in the queue, waits while the queue is full """
+        while not self.stop.is_set():
+            try:
+                self.queues[qidx].put(item, timeout=0.5)
+                return
+            except Full:
+                continue
+
+    def _get(self, qidx):
+        """ Get item from the queue, None when the upstream stage is done or pipeline stopped """
+        while True:
+            try:
+                return self.queues[qidx].get(timeout=0.5)
+            except Empty:
+                if self.stop.is_set():
+                    return None
+
+    def _run_stage(self, stage, fnc, *args):
+        """ Run the stage, on error stop the pipeline """
+        try:
+            fnc(*args)
+        except Exception as err:
+            print(f"Ingest stage {stage} failed: {err}")
+            self.errors.append(err)
+            self.stop.set()
+
+    def _reader(self, fldr):
+        for rfl in sorted(fldr.rglob('*')):
+            if self.stop.is_set():
+                return
+            if not rfl.is_file():
+                continue
+            btime = perf_counter()
+            stat = rfl.stat()
+            item = {"path": rfl, "key": rfl.relative_to(fldr).as_posix(),
+                    "parent": rfl.parent.name if rfl.parent != fldr else '.',
+                    "fingerprint": f"{stat.st_size}-{stat.st_mtime_ns}"}
+            if self.done.get(item["key"]) != item["fingerprint"]:
+                with open(rfl, encoding="utf-8", errors="replace") as txt_fl:
+                    item["lines"] = txt_fl.readlines()
+            self.stats["reader"]["files"] += 1
+            self.stats["reader"]["busy"] += perf_counter() - btime
+            self._put(0, item)
+        self._put(0, None)
+
+    def _chunker(self):
+        while (item := self._get(0)) is not None:
+            btime = perf_counter()
+            chunks = []
+            if "lines" in item:
+                txtchunk = ''
+                txtlst = []
+                for txt in item["lines"]:
+                    txt = txt.strip()
+                    txtchunk = f"{txtchunk} {txt}"
+                    txtlst.append(txt)
+                    if len(txtchunk.split()) >= _MAX_TKNLEN:
+                        chunks.append((txtchunk, txtlst))
+                        txtchunk = ''
+                        txtlst = []
+                if txtchunk.strip():
+                    chunks.append((txtchunk, txtlst))
+                item["chunks"] = chunks
+            self.stats["chunker"]["files"] += 1
+            self.stats["chunker"]["chunks"] += len(chunks)
+            self.stats["chunker"]["busy"] += perf_counter() - btime
+            self._put(1, item)
+        self._put(1, None)
+
+    def _encoder(self):
+        upstream_done = False
+        while not upstream_done and (item := self._get(1)) is not None:
+            # Batch chunks of the files already waiting, keeps the model busy with larger batches
+            items = [item]
+            nchunks = len(item.get("chunks", []))
+            while nchunks < _ENC_BATCH:
+                try:
+                    nxt = self.queues[1].get_nowait()
+                except Empty:
+                    break
+                if nxt is None:
+                    upstream_done = True
+                    break
+                items.append(nxt)
+                nchunks += len(nxt.get("chunks", []))
+            btime = perf_counter()
+            embed_strs = self.emb.get_embedding_strs([chunk[0] for itm in items
+                                                      for chunk in itm.get("chunks", [])])
+            self.stats["encoder"]["busy"] += perf_counter() - btime
+            self.stats["encoder"]["files"] += len(items)
+            self.stats["encoder"]["chunks"] += nchunks
+            for itm in items:
+                cnt = len(itm.get("chunks", []))
+                itm["embeddings"], embed_strs = embed_strs[:cnt], embed_strs[cnt:]
+                self._put(2, itm)
+        self._put(2, None)
+
+    def _writer(self):
+        while (item := self._get(2)) is not None:
+            btime = perf_counter()
+            rfl = item["path"]
+            if "chunks" in item:
+                self._save_document(item)
+                print(f"Embeddings commited for file: {rfl}")
+            else:
+                print(f"Text file already processed: {rfl}")
+            Path(_TXTSREADDIR, item["parent"]).mkdir(parents=True, exist_ok=True)
+            try:
+                _ = rfl.replace(Path(_TXTSREADDIR, item["parent"], rfl.name))
+            except (PermissionError, FileExistsError, FileNotFoundError) as err:
+                print(f"File not moved: {err}")
+                print("Ignoring error...")
+            else:
+                # File is out of _TEXTDIR, a file placed back later is ingested again
+                _ = self.emb.dbexec(self.ingest_stmts['del_ckpt'], (item["key"], ),
+                                    "Delete ingest checkpoint")
+                self.emb.dbo.commit()
+            self.stats["writer"]["files"] += 1
+            self.stats["writer"]["chunks"] += len(item.get("chunks", []))
+            self.stats["writer"]["busy"] += perf_counter() - btime
+
+    def _save_document(self, item):
+        """ Save document chunks+embeddings and the checkpoint, in one transaction """
+        emb, name = self.emb, item["path"].name
+        # If the file has been processed already, delete the document chunks and reprocess
+        docid = emb.dbexec(emb.dbo_stmts['sel_doc'], (name, ), "Check for Document")
+        if docid:
+            _ = emb.dbexec(emb.dbo_stmts['del_txts'], (docid[0][0], ), "Deleting document chunks")
+            _ = emb.dbexec(emb.dbo_stmts['upd_doc'], (datetime.now(tz=timezone.utc), docid[0][0]),
+                           "Updating document timestamp")
+            if _CACHE_ENABLED:
+                # Cached context answers built on the old chunks are stale
+                _ = emb.dbexec(emb.dbo_stmts['del_cache_doc'], (docid[0][0], ),
+                               "Invalidating cached answers")
+        else:
+            docid = emb.dbexec(emb.dbo_stmts['ins_doc'], (name, ), "Insert Document")
+        if emb.idxo:
+            part_key = get_part_key(name, item["parent"])
+            emb.idxo.create_partition(part_key)
+        for (_, txtlst), embed_str in zip(item["chunks"], item["embeddings"]):
+            if emb.idxo:
+                _ = emb.dbexec(emb.dbo_stmts['ins_txt_part'],
+                               (docid[0][0], json.dumps(txtlst), embed_str, part_key),
+                               "Insert chunk into Document")
+            else:
+                _ = emb.dbexec(emb.dbo_stmts['ins_txt'],
+                               (docid[0][0], json.dumps(txtlst), embed_str),
+                               "Insert chunk into Document")
+        _ = emb.dbexec(self.ingest_stmts['ups_ckpt'],
+                       (item["key"], item["fingerprint"], docid[0][0], len(item["chunks"])),
+                       "Save ingest checkpoint")
+        emb.dbo.commit()
+
+    def _remove_dirs(self, fldr):
+        """ Delete the processed text directories, ignore error if any file exists """
+        for rdir in sorted((itm for itm in fldr.rglob('*') if itm.is_dir()), reverse=True):
+            try:
+                rdir.rmdir()
+            except (OSError, FileNotFoundError) as err:
+                print(f"Directory not deleted: {err}")
+                print("Ignoring error...")
+
+    def report(self, wall):
+        """ Print throughput per stage and the bottleneck stage """
+        print(f"Ingest completed in {precisedelta(wall)}")
+        for stage, stat in self.stats.items():
+            busy = stat["busy"]
+            print(f"  {stage:8}: {stat['files']} files, {stat['chunks']} chunks, "
+                  f"busy {busy:.1f}s ({busy/(wall.total_seconds() or 1):.0%}), "
+                  f"{stat['files']/busy if busy else 0:.1f} files/sec, "
+                  f"{stat['chunks']/busy if busy else 0:.1f} chunks/sec")
+        bottleneck = max(self.stats, key=lambda stage: self.stats[stage]["busy"])
+        print(f"Bottleneck stage: {bottleneck}")
+
+    def run(self, fldr):
+        """ Run the pipeline for all files under fldr, returns per stage stats """
+        btime = datetime.now()
+        self.done = dict(self.emb.dbexec(self.ingest_stmts['sel_ckpt'], None,
+                                         "Get ingest checkpoints"))
+        self.emb.dbo.commit()
+        thrds = [threading.Thread(target=self._run_stage, args=("reader", self._reader, fldr)),
+                 threading.Thread(target=self._run_stage, args=("chunker", self._chunker)),
+                 threading.Thread(target=self._run_stage, args=("encoder", self._encoder)),
+                 threading.Thread(target=self._run_stage, args=("writer", self._writer))]
+        for thrd in thrds:
+            thrd.start()
+        for thrd in thrds:
+            thrd.join()
+        if self.errors:
+            raise self.errors[0]
+        self._remove_dirs(fldr)
+        self.report(datetime.now() - btime)
+        return self.stats
+
+
+class ChunkIndexOps():
+    """
+    HNSW index and partition management of t_document_chunks
+    For bulk loads, drop the index, load and rebuild the index once.
+    Avoids the incremental index maintenance cost on every insert.
+    """
+    idx_name = "t_document_chunks_embedding_idx"
+
+    def __init__(self, emb):
+        self.emb = emb
+        # Partitions created in this session
+        self.parts = set()
+        self.idx_stmts = {"sel_parts":"select c.relname from pg_inherits i \
+                                join pg_class c on c.oid = i.inhrelid \
+                                where i.inhparent = 't_document_chunks'::regclass",
+                     "set_cfg":"select set_config(%s, %s, false)",
+                    }
+
+    def part_name(self, part_key):
+        """ Partition table name for the partition key, e.g. runtime/7_2_17 """
+        name = re.sub(r'\W+', '_', part_key.lower())[:22]
+        # Hash keeps the names of keys differing only in special chars or after 22 chars unique
+        khash = hashlib.md5(part_key.encode("utf-8")).hexdigest()[:8]
+        # Postgres identifiers are limited to 63 chars, 49 leaves space for _embedding_idx
+        return f"t_document_chunks_{name}_{khash}"
+
+    def create_partition(self, part_key):
+        """ Create the partition for the partition key, if not exists """
+        if part_key in self.parts:
+            return
+        stmt = sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF t_document_chunks \
+                        FOR VALUES IN ({})").format(sql.Identifier(self.part_name(part_key)),
+                                                     sql.Literal(part_key))
+        _ = self.emb.dbexec(stmt, None, f"Create partition for {part_key}")
+        self.parts.add(part_key)
+
+    def get_partitions(self):
+        """ Returns the partition table names of t_document_chunks """
+        return [itm[0] for itm in self.emb.dbexec(self.idx_stmts['sel_parts'], None,
+                                                   "Get partitions")]
+
+    def drop_index(self):
+        """ Drop the HNSW index, partition indexes are dropped as well """
+        stmt = sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(self.idx_name))
+        _ = self.emb.dbexec(stmt, None, "Drop HNSW index")
+        self.emb.dbo.commit()
+
+    def _create_index_stmt(self, idx, tbl, concurrently=False, only=False):
+        return sql.SQL("CREATE INDEX {} IF NOT EXISTS {} ON {} {} USING hnsw \
+                        (embedding vector_ip_ops) WITH (m = {}, ef_construction = {})").format(
+                            sql.SQL("CONCURRENTLY" if concurrently else ''), sql.Identifier(idx),
+                            sql.SQL("ONLY" if only else ''), sql.Identifier(tbl),
+                            sql.Literal(_HNSW_M), sql.Literal(_HNSW_EF_CONSTRUCTION))
+
+    def _set_maint_cfg(self):
+        """ Session settings for a faster index build """
+        for cfg, val in (("maintenance_work_mem", _IDX_MAINT_WORK_MEM),
+                         ("max_parallel_maintenance_workers", str(_IDX_PARALLEL_WORKERS))):
+            _ = self.emb.dbexec(self.idx_stmts['set_cfg'], (cfg, val), f"Set {cfg}")
+
+    def build_index(self, concurrently=False):
+        """
+        Build the HNSW index with _IDX_MAINT_WORK_MEM and _IDX_PARALLEL_WORKERS
+        concurrently=True builds the index online, without blocking writes.
+        Partitioned table: each partition index is built concurrently and attached.
+        Returns the index build duration
+        """
+        btime = datetime.now()
+        self.emb.dbo.commit()
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        self.emb.dbo.autocommit(True)
+        try:
+            self._set_maint_cfg()
+            if not concurrently:
+                _ = self.emb.dbexec(self._create_index_stmt(self.idx_name, "t_document_chunks"),
+                                    None, "Create HNSW index")
+            elif _PG_PARTITIONED:
+                # Invalid parent index, valid once all partition indexes are attached
+                _ = self.emb.dbexec(self._create_index_stmt(self.idx_name, "t_document_chunks",
+                                                            only=True),
+                                    None, "Create HNSW index")
+                for part in self.get_partitions():
+                    print(f"Creating HNSW index on partition: {part}")
+                    _ = self.emb.dbexec(self._create_index_stmt(f"{part}_embedding_idx", part,
+                                                                concurrently=True),
+                                        None, f"Create HNSW index on {part}")
+                    stmt = sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(
+                                    sql.Identifier(self.idx_name),
+                                    sql.Identifier(f"{part}_embedding_idx"))
+                    _ = self.emb.dbexec(stmt, None, f"Attach HNSW index of {part}")
+            else:
+                _ = self.emb.dbexec(self._create_index_stmt(self.idx_name, "t_document_chunks",
+                                                            concurrently=True),
+                                    None, "Create HNSW index")
+        finally:
+            self.emb.dbo.autocommit(False)
+        return datetime.now() - btime
+
+    def reindex(self, part_key='', concurrently=False):
+        """
+        Rebuild t_document_chunks indexes, or only of the part_key partition
+        Returns the reindex duration
+        """
+        tbl = "t_document_chunks"
+        if part_key:
+            if not _PG_PARTITIONED:
+                raise ValueError("part_key requires a partitioned t_document_chunks, "
+                                 "see _PG_PARTITIONED")
+            tbl = self.part_name(part_key)
+            if tbl not in self.get_partitions():
+                raise ValueError(f"No partition for part_key {part_key}")
+        btime = datetime.now()
+        stmt = sql.SQL("REINDEX TABLE {} {}").format(
+                        sql.SQL("CONCURRENTLY" if concurrently else ''), sql.Identifier(tbl))
+        self.emb.dbo.commit()
+        self.emb.dbo.autocommit(True)
+        try:
+            self._set_maint_cfg()
+            _ = self.emb.dbexec(stmt, None, f"Reindex {tbl}")
+        finally:
+            self.emb.dbo.autocommit(False)
+        return datetime.now() - btime
+
+
+class AnswerCache():
+    """
+    Semantic answer cache stored in pgvector DB, t_answer_cache
+    Answers are keyed by mode (ANSWER/CONTEXT), temperature and the normalized query embedding.
+    A query within _CACHE_SIM_THRESHOLD of a cached query returns the cached answer.
+    """
+
+    def __init__(self, emb):
+        self.emb = emb
+        self.ttl = timedelta(hours=_CACHE_TTL_HRS)
+        self.hits = {"ANSWER": 0, "CONTEXT": 0}
+        self.misses = {"ANSWER": 0, "CONTEXT": 0}
+        # <#> returns the negative inner product, similarity = -(a <#> b)
+        # t_answer_cache has no HNSW index, exact scan of the mode and temp rows
+        self.cache_stmts = {"sel_ans":"SELECT id, answer, -(embedding <#> %s) FROM t_answer_cache \
+                                 WHERE mode = %s and temp = %s and created_at > now() - %s \
+                                 ORDER BY embedding <#> %s LIMIT 1",
+                       "upd_hit":"update t_answer_cache set hits = hits + 1, last_hit_at = now() \
+                                 where id = %s",
+                       "ins_ans":"insert into t_answer_cache \
+                                 (mode, temp, query, embedding, answer, doc_ids) \
+                                 values(%s, %s, %s, %s, %s, %s::bigint[])",
+                       "del_ttl":"delete from t_answer_cache where created_at <= now() - %s",
+                       "del_lru":"delete from t_answer_cache where id in (select id from t_answer_cache \
+                                 order by coalesce(last_hit_at, created_at) desc offset %s)",
+                       "sel_stats":"select mode, count(*), coalesce(sum(hits), 0) \
+                                 from t_answer_cache group by mode"
+                      }
+
+    def lookup(self, mode, temp, embed_str):
+        """
+        Returns the cached answer for the query embedding, generated with the same temperature
+        '' if none within threshold
+        """
+        res = self.emb.dbexec(self.cache_stmts['sel_ans'],
+                              (embed_str, mode, temp, self.ttl, embed_str),
+                              "Lookup answer cache")
+        if res and res[0][2] >= _CACHE_SIM_THRESHOLD:
+            _ = self.emb.dbexec(self.cache_stmts['upd_hit'], (res[0][0], ), "Update cache hit")
+            self.emb.dbo.commit()
+            self.hits[mode] += 1
+            print(f"Answer cache hit, mode={mode}, similarity={res[0][2]:.3f}")
+            return res[0][1]
+        self.misses[mode] += 1
+        return ''
+
+    def store(self, mode, temp, qry, embed_str, answer, doc_ids=()):
+        """ Save the answer in cache and evict expired, least recently used answers """
+        _ = self.emb.dbexec(self.cache_stmts['ins_ans'],
+                            (mode, temp, qry, embed_str, answer, list(doc_ids)),
+                            "Insert answer cache")
+        _ = self.emb.dbexec(self.cache_stmts['del_ttl'], (self.ttl, ), "Evict expired answers")
+        _ = self.emb.dbexec(self.cache_stmts['del_lru'], (_CACHE_MAX_ROWS, ),
+                            "Evict least recently used answers")
+        self.emb.dbo.commit()
+
+    def stats(self):
+        """
+        Returns cache metrics per mode
+        hits, misses, hit_rate of this session; rows and total hits stored in DB
+        """
+        dbstats = {itm[0]: itm[1:] for itm in self.emb.dbexec(self.cache_stmts['sel_stats'], None,
+                                                               "Get answer cache stats")}
+        stats = {}
+        for mode, hits in self.hits.items():
+            total = hits + self.misses[mode]
+            rows, db_hits = dbstats.get(mode, (0, 0))
+            stats[mode] = {"hits": hits, "misses": self.misses[mode],
+                           "hit_rate": hits/total if total else 0.0,
+                           "rows": rows, "db_hits": db_hits}
+        return stats
+
+
 class LLMOps():
-    """For LLM operations """
-    def __init__(self):
+    """For LLM operations
+    llm_name, draft_name default to _LLM_NAME, _LLM_DRAFT_NAME.
+    e.g. a pair of small models to try assisted generation on CPU
+    """
+    def __init__(self, llm_name=_LLM_NAME, draft_name=_LLM_DRAFT_NAME):
         self.pipeline = transformers.pipeline("text-generation",
-                                              model=_LLM_NAME,
+                                              model=llm_name,
                                               torch_dtype=torch.bfloat16,
                                               device_map="auto",
                                              )
+        self.draft_mdl = ''
+        if draft_name:
+            self.draft_mdl = transformers.AutoModelForCausalLM.from_pretrained(
+                                draft_name, torch_dtype=self.pipeline.model.dtype,
+                                ).to(self.pipeline.model.device)
+            print(f"Draft model {draft_name} ok.")
+        # Tokens, tokens/sec and draft tokens acceptance of the last generation
+        self.gen_stats = {}
+        self.gen_ids = []
         self.gconfigdct = self.pipeline.model.generation_config.to_dict()
         self.gconfigdct["max_new_tokens"] =256
         self.gconfigdct["do_sample"] = True
@@ -230,18 +783,90 @@ class LLMOps():
         self.gconfigdct["top_p"] = 0.95
         self.gconfigdct["pad_token_id"] = self.pipeline.model.config.eos_token_id
         self.emb = ''
+        self.cache = ''
+
+    def generate(self, prompt, gconfig, assisted=True):
+        """
+        Generate text for the prompt, assisted by the draft model if available
+        Returns the generated text, generated token ids in gen_ids, generation stats in gen_stats
+        """
+        # Forward passes of each model. Every LLM pass accepts the matching draft tokens,
+        # plus one token of its own
+        fwd = {"llm": 0, "draft": 0}
+        def _counter(mdl):
+            def _hook(*_):
+                fwd[mdl] += 1
+            return _hook
+        hooks = [self.pipeline.model.register_forward_hook(_counter("llm"))]
+        kwargs = {}
+        if assisted and self.draft_mdl:
+            kwargs["assistant_model"] = self.draft_mdl
+            hooks.append(self.draft_mdl.register_forward_hook(_counter("draft")))
+        # Same tokenization as the text-generation pipeline, chat template has the special tokens
+        inputs = self.pipeline.tokenizer(prompt, add_special_tokens=False,
+                                         return_tensors="pt").to(self.pipeline.model.device)
+        btime = perf_counter()
+        try:
+            outputs = self.pipeline.model.generate(**inputs, generation_config=gconfig, **kwargs)
+        finally:
+            for hook in hooks:
+                hook.remove()
+        secs = perf_counter() - btime
+        # Count the generated ids, including special tokens e.g. EOS
+        self.gen_ids = outputs[0][inputs["input_ids"].shape[1]:].tolist()
+        res = self.pipeline.tokenizer.decode(self.gen_ids, skip_special_tokens=True)
+        tkns = len(self.gen_ids)
+        self.gen_stats = {"tokens": tkns, "secs": secs, "tokens_per_sec": tkns/secs if secs else 0.0}
+        if kwargs:
+            accepted = max(tkns - fwd["llm"], 0)
+            self.gen_stats.update({"draft_tokens": fwd["draft"], "accepted": accepted,
+                                   "acceptance_rate": accepted/fwd["draft"] if fwd["draft"] else 0.0})
+            print(f"Assisted generation: {tkns} tokens, {self.gen_stats['tokens_per_sec']:.1f} "
+                  f"tokens/sec, draft acceptance {self.gen_stats['acceptance_rate']:.0%}")
+        return res
 
-    def mdl_ui_response(self, qry, temp=7, qrycontext="ANSWER"):
+    def assisted_speedup(self, qry, max_new_tokens=128):
+        """
+        Compare greedy generation with and without the draft model
+        Returns the stats of both, tokens/sec speedup and if the answers are identical
+        """
+        _LLM_MSG_TMPLT[1]['content'] = qry
+        prompt = self.pipeline.tokenizer.apply_chat_template(_LLM_MSG_TMPLT, tokenize=False,
+                                                             add_generation_prompt=True)
+        gconfigdct = dict(self.gconfigdct, do_sample=False, max_new_tokens=max_new_tokens)
+        for key in ("temperature", "top_k", "top_p"):
+            gconfigdct.pop(key, None)
+        # Warm up both, the first generation pays one time costs e.g. CUDA kernels, caches
+        wconfig = transformers.GenerationConfig(**dict(gconfigdct, max_new_tokens=8))
+        _ = self.generate(prompt, wconfig, assisted=False)
+        _ = self.generate(prompt, wconfig)
+        gconfig = transformers.GenerationConfig(**gconfigdct)
+        _ = self.generate(prompt, gconfig, assisted=False)
+        stats = {"llm": self.gen_stats}
+        ids = self.gen_ids
+        _ = self.generate(prompt, gconfig)
+        stats["assisted"] = self.gen_stats
+        stats["identical"] = ids == self.gen_ids
+        stats["speedup"] = (stats["assisted"]["tokens_per_sec"]/stats["llm"]["tokens_per_sec"]
+                            if stats["llm"]["tokens_per_sec"] else 0.0)
+        print(f"LLM: {stats['llm']['tokens_per_sec']:.1f} tokens/sec, "
+              f"assisted: {stats['assisted']['tokens_per_sec']:.1f} tokens/sec, "
+              f"speedup {stats['speedup']:.2f}x, identical answers: {stats['identical']}")
+        return stats
+
+    def mdl_ui_response(self, qry, temp=7, qrycontext="ANSWER", part_key=''):
         """ Function returns ui friendly answer from the LLM """
-        ans = self.mdl_response(qry, temp, qrycontext)
+        ans = self.mdl_response(qry, temp, qrycontext, part_key)
         return (f"{ans[0][0]}\n\n{ans[0][1]}",
                 f"{ans[1][0]}\n\n{ans[1][1]}")
 
-    def mdl_response(self, qry, temp=7, qrycontext="BOTH"):
+    def mdl_response(self, qry, temp=7, qrycontext="BOTH", part_key=''):
         """ Function returns the answer from the LLM
         If qrycontext="ANSWER", then LLM answer only
         If qrycontext="CONTEXT", then LLM answer with context (RAG)
         If qrycontext="BOTH", then both
+        part_key (product/version, e.g. runtime/7_2_17) limits the context search to the
+        partition, if t_document_chunks is partitioned. Such answers are not cached.
         Returns a tuple ("Query ANSWER", "With context ANSWER")
         """
         if temp < 1 or temp > 9:
@@ -253,27 +878,63 @@ class LLMOps():
                                                                  add_generation_prompt=True)
             self.gconfigdct["temperature"] = temp/10
             gconfig = transformers.GenerationConfig(**self.gconfigdct)
-            outputs = self.pipeline(prompt, generation_config=gconfig)
-            res = outputs[0]["generated_text"].split("<|assistant|>\n")[1]
+            res = self.generate(prompt, gconfig)
             return (res, precisedelta(datetime.now() - btime))
 
-        if qrycontext == "ANSWER":
-            fnl_res = (_get_ans(qry), '')
-        elif qrycontext == "CONTEXT":
+        def _get_mode_ans(mode, embed_str):
+            """ Answer for the mode, from the answer cache if a similar query is cached """
+            # Cached context answers are built from the whole table
+            use_cache = _CACHE_ENABLED and not (mode == "CONTEXT" and part_key)
+            if use_cache:
+                btime = datetime.now()
+                ans = self.cache.lookup(mode, temp, embed_str)
+                if ans:
+                    return (ans, precisedelta(datetime.now() - btime))
+            doc_ids = []
+            if mode == "ANSWER":
+                res = _get_ans(qry)
+            else:
+                contxt = self.emb.get_similar_texts(qry, embed_str, part_key)
+                if not contxt.strip():
+                    # Nothing to prompt the LLM with, not cached
+                    return ("No relevant context found", '')
+                res = _get_ans(contxt)
+                doc_ids = self.emb.ctx_doc_ids
+            if use_cache:
+                self.cache.store(mode, temp, qry, embed_str, res[0], doc_ids)
+            return res
+
+        if len(qry.split()) < 2:
+            return (("Ask a good question", ''), '')
+        embed_str = ''
+        if _CACHE_ENABLED or qrycontext != "ANSWER":
             if not self.emb:
                 self.emb = Embeds()
-            fnl_res = ('', _get_ans(self.emb.get_similar_texts(qry)) )
+            # Query embedding is computed once, used for cache lookup and similar texts
+            embed_str = self.emb.get_embedding_str(qry)
+        if _CACHE_ENABLED and not self.cache:
+            self.cache = AnswerCache(self.emb)
+
+        if qrycontext == "ANSWER":
+            fnl_res = (_get_mode_ans("ANSWER", embed_str), '')
+        elif qrycontext == "CONTEXT":
+            fnl_res = ('', _get_mode_ans("CONTEXT", embed_str))
         elif qrycontext == "BOTH":
-            msg1 = _get_ans(qry)
-            if not self.emb:
-                self.emb = Embeds()
-            msg2 = _get_ans(self.emb.get_similar_texts(qry))
-            fnl_res = (msg1, msg2)
-        if len(qry.split()) < 2:
-            fnl_res = (("Ask a good question", ''), '')
+            fnl_res = (_get_mode_ans("ANSWER", embed_str), _get_mode_ans("CONTEXT", embed_str))
         return fnl_res
 
 
+def get_part_key(doc_name, parent='.'):
+    """
+    Partition key product/version of a text file
+    Product is the document directory, version is the document name prefix
+    e.g. runtime/7_2_17-atlas-overview_html.txt -> runtime/7_2_17
+    """
+    product = parent if parent not in ('', '.') else 'default'
+    version = doc_name.split('-')[0] if '-' in doc_name else 'default'
+    return f"{product}/{version}"
+
+
 def run_spider(spiderfl):
     """ In case the program is called as a python program instead of 
     scrapy runspider cdp-spider.py
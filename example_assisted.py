@@ -0,0 +1,24 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Example script to compare LLM greedy generation with and without the draft model
+Usage: python example_assisted.py [llm_name draft_name]
+Defaults to _LLM_NAME, _LLM_DRAFT_NAME. For a quick CPU check, use a pair of small models
+sharing the tokenizer, e.g. python example_assisted.py gpt2-medium distilgpt2
+"""
+
+import sys
+
+from coreconfigs import _LLM_NAME, _LLM_DRAFT_NAME
+from coreutils import LLMOps
+
+
+llm_name, draft_name = sys.argv[1:3] if len(sys.argv) > 2 else (_LLM_NAME, _LLM_DRAFT_NAME)
+if not draft_name:
+    print("Draft model not configured, set _LLM_DRAFT_NAME in coreconfigs.py")
+    sys.exit(1)
+llm = LLMOps(llm_name, draft_name)
+
+stats = llm.assisted_speedup("what is apache atlas")
+print(f"Draft tokens: {stats['assisted']['draft_tokens']}, "
+      f"accepted: {stats['assisted']['accepted']} ({stats['assisted']['acceptance_rate']:.0%})")
@@ -12,7 +12,32 @@ CREATE TABLE t_document_chunks (id bigserial PRIMARY KEY,
 							  embedding vector(384),
 							  created_at timestamp default now());
 
-CREATE INDEX ON t_document_chunks USING hnsw (embedding vector_ip_ops) WITH (m = 16, ef_construction = 128);
+CREATE INDEX t_document_chunks_embedding_idx ON t_document_chunks USING hnsw (embedding vector_ip_ops) WITH (m = 16, ef_construction = 128);
+
+CREATE TABLE t_answer_cache (id bigserial PRIMARY KEY,
+							  mode varchar(8) not null,
+							  temp smallint not null,
+							  query text,
+							  embedding vector(384),
+							  answer text,
+							  doc_ids bigint[] default '{}',
+							  hits integer default 0,
+							  last_hit_at timestamp,
+							  created_at timestamp default now());
+
+-- No HNSW index: the table is small (_CACHE_MAX_ROWS) and lookups filter by mode and temp.
+-- An exact scan never misses a cached answer filtered out of the approximate candidates.
+CREATE INDEX ON t_answer_cache USING gin (doc_ids);
+
+CREATE TABLE t_ingest_checkpoint (file_path varchar(512) PRIMARY KEY,
+							  fingerprint varchar(64),
+							  doc_id bigint,
+							  chunks integer,
+							  updated_at timestamp default now());
+
+-- bulk_load.py drops, creates and reindexes the HNSW index, requires table ownership
+ALTER TABLE t_document_chunks OWNER TO ragu;
+
 GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA PUBLIC to ragu;
 GRANT ALL ON ALL SEQUENCES IN SCHEMA PUBLIC to ragu;
 \q
@@ -0,0 +1,27 @@
+-- Optional: t_document_chunks partitioned by product/version (part_key), e.g. runtime/7_2_17
+-- Run after pgvector.sql on a new database, and set _PG_PARTITIONED = True in coreconfigs.py
+-- Partitions are created by the application when a document of a new product/version is stored
+\c ragdb
+DROP TABLE t_document_chunks;
+
+CREATE TABLE t_document_chunks (id bigserial,
+							  doc_id bigint not null references t_documents(id),
+							  chunk jsonb,
+							  embedding vector(384),
+							  part_key varchar(128) not null,
+							  created_at timestamp default now(),
+							  PRIMARY KEY (id, part_key)) PARTITION BY LIST (part_key);
+
+CREATE TABLE t_document_chunks_default PARTITION OF t_document_chunks DEFAULT;
+
+CREATE INDEX t_document_chunks_embedding_idx ON t_document_chunks USING hnsw (embedding vector_ip_ops) WITH (m = 16, ef_construction = 128);
+CREATE INDEX ON t_document_chunks (doc_id);
+-- bulk_load.py manages the indexes and the application creates partitions,
+-- both require table ownership
+ALTER TABLE t_document_chunks OWNER TO ragu;
+ALTER TABLE t_document_chunks_default OWNER TO ragu;
+GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA PUBLIC to ragu;
+GRANT ALL ON ALL SEQUENCES IN SCHEMA PUBLIC to ragu;
+-- Application creates partitions, requires CREATE privilege on the schema
+GRANT CREATE ON SCHEMA PUBLIC to ragu;
+\q
@@ -0,0 +1,39 @@
+-- Upgrade an existing ragdb database, created with an earlier pgvector.sql
+-- Safe to run more than once
+\c ragdb
+CREATE TABLE IF NOT EXISTS t_answer_cache (id bigserial PRIMARY KEY,
+							  mode varchar(8) not null,
+							  temp smallint not null,
+							  query text,
+							  embedding vector(384),
+							  answer text,
+							  doc_ids bigint[] default '{}',
+							  hits integer default 0,
+							  last_hit_at timestamp,
+							  created_at timestamp default now());
+
+-- Answer cache lookups use an exact scan, see pgvector.sql
+DROP INDEX IF EXISTS t_answer_cache_embedding_idx;
+CREATE INDEX IF NOT EXISTS t_answer_cache_doc_ids_idx ON t_answer_cache USING gin (doc_ids);
+
+CREATE TABLE IF NOT EXISTS t_ingest_checkpoint (file_path varchar(512) PRIMARY KEY,
+							  fingerprint varchar(64),
+							  doc_id bigint,
+							  chunks integer,
+							  updated_at timestamp default now());
+
+-- bulk_load.py drops, creates and reindexes the HNSW index, partitions are created by
+-- the application, both require ownership of t_document_chunks and its partitions
+ALTER TABLE t_document_chunks OWNER TO ragu;
+DO $$
+DECLARE part regclass;
+BEGIN
+	FOR part IN SELECT inhrelid::regclass FROM pg_inherits
+				WHERE inhparent = 't_document_chunks'::regclass LOOP
+		EXECUTE format('ALTER TABLE %s OWNER TO ragu', part);
+	END LOOP;
+END $$;
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA PUBLIC to ragu;
+GRANT ALL ON ALL SEQUENCES IN SCHEMA PUBLIC to ragu;
+\q